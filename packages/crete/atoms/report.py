@@ -1,7 +1,13 @@
 from pathlib import Path
-from typing import Literal
-
-from pydantic import BaseModel, TypeAdapter
+from typing import Annotated, Any, Literal, cast
+
+from pydantic import (
+    BaseModel,
+    Field,
+    TypeAdapter,
+    field_serializer,
+    field_validator,
+)
 
 from crete.commons.interaction.exceptions import TimeoutExpired
 from crete.commons.logging.context_managers import logging_performance
@@ -9,7 +15,7 @@ from crete.framework.agent.contexts import AgentContext
 from crete.framework.agent.functions import store_debug_file
 from crete.framework.context_builder.protocols import ContextBuilderProtocol
 from crete.framework.environment.exceptions import ChallengeTestFailedError
-from crete.framework.scheduler.tracker.models import LlmUsage
+from crete.framework.scheduler.tracker.models import LlmUsage, micro_dollars
 
 from .action import (
     Action,
@@ -30,6 +36,24 @@ class BaseResult(BaseModel):
     source_directory: Path
     llm_usage: LlmUsage = LlmUsage()
 
+    # Micro-dollars are internal to `LlmUsage`, the reports keep `total_cost`
+    @field_validator("llm_usage", mode="before")
+    @classmethod
+    def _validate_llm_usage(cls, value: Any) -> Any:
+        if isinstance(value, dict) and "total_cost" in value:
+            usage = cast(dict[str, Any], value).copy()
+            usage["total_cost_micro"] = micro_dollars(usage.pop("total_cost"))
+            return usage
+        return value
+
+    @field_serializer("llm_usage")
+    def _serialize_llm_usage(self, llm_usage: LlmUsage) -> dict[str, float | int]:
+        return {
+            "total_cost": llm_usage.total_cost,
+            "prompt_tokens": llm_usage.prompt_tokens,
+            "completion_tokens": llm_usage.completion_tokens,
+        }
+
 
 class NoPatchResult(BaseResult):
     variant: Literal["no_patch"]
@@ -56,7 +80,10 @@ class ErrorResult(BaseResult):
 
 # TODO(v4): rename better
 CreteResult = NoPatchResult | DiffResult | ErrorResult
-CreteResultModel = TypeAdapter[DiffResult | ErrorResult](CreteResult)
+# The variant field selects the result type while the result is validated
+CreteResultModel: TypeAdapter[CreteResult] = TypeAdapter(
+    Annotated[CreteResult, Field(discriminator="variant")]
+)
 
 
 def result_from_action(
@@ -17,6 +17,20 @@ def store_debug_file(
         context["logger"].info(f"{store_path}: {content}")
 
 
+def store_debug_files(
+    context: LoggingContext, files: dict[str, str], log_output: bool = True
+) -> None:
+    agent_context = cast(AgentContext, context)
+    if "output_directory" not in agent_context:
+        return
+    agent_context["output_directory"].mkdir(parents=True, exist_ok=True)
+    for name, content in files.items():
+        store_path = agent_context["output_directory"] / name
+        store_path.write_text(content)
+        if log_output:
+            context["logger"].info(f"{store_path}: {content}")
+
+
 def append_debug_file(
     context: LoggingContext, name: str, content: str, log_output: bool = True
 ) -> None:
@@ -1,7 +1,10 @@
 """CCAgent - Claude Code Agent using the Claude Agent SDK (Python)."""
+import asyncio
 import inspect
+import string
+import weakref
 from pathlib import Path
-from typing import Iterator
+from typing import Callable, Iterator
 
 from crete.atoms.action import (
     Action,
@@ -15,12 +18,14 @@ from crete.atoms.action import (
 from crete.atoms.detection import Detection
 from crete.commons.crash_analysis.functions import get_bug_class
 from crete.framework.agent.contexts import AgentContext
-from crete.framework.agent.functions import store_debug_file
+from crete.framework.agent.functions import store_debug_files
 from crete.framework.agent.protocols import AgentProtocol
 from crete.framework.coder.services.cc import CCCoder
 from crete.framework.insighter.protocols import InsighterProtocol
 from crete.framework.insighter.services.crash_log import CrashLogInsighter
 
+# The static part of the prompt comes first so that it is byte-identical across
+# iterations and can be served from Anthropic's prompt cache.
 CC_USER_PROMPT_TEMPLATE = inspect.cleandoc(
     """
     Create a patch to fix a {bug_class} bug given below and apply it to the code.
@@ -33,7 +38,7 @@ CC_USER_PROMPT_TEMPLATE = inspect.cleandoc(
 
 CC_USER_PROMPT_TEMPLATE_WITH_FEEDBACK = inspect.cleandoc(
     """
-    I tried to fix a {bug_class} vulnerability causing the crash log in the <crash_log> below.
+    I tried to fix the vulnerability causing the crash log above.
     I failed to fix the vulnerability with the following patches:
 
     {failed_patch}
@@ -41,10 +46,6 @@ CC_USER_PROMPT_TEMPLATE_WITH_FEEDBACK = inspect.cleandoc(
     Explain why the patches failed and provide a new patch to fix the vulnerability.
     Do not repeat the same mistakes in the new patch.
     Try a completely different approach to fix the vulnerability.
-    NEVER fix files outside the source directory.
-    NEVER do any git operations in or outside the source directory.
-
-    {insights}
     """
 ).lstrip()
 
@@ -68,6 +69,42 @@ FAILED_PATCH_TEMPLATE = inspect.cleandoc(
 )
 
 
+def _compile_template(template: str) -> Callable[..., str]:
+    # The template is split into literals and fields once, so that formatting
+    # does not parse the format string again on every call.
+    parts = list(string.Formatter().parse(template))
+    assert all(
+        spec in ("", None) and conversion is None for _, _, spec, conversion in parts
+    ), "Format specs and conversions are not supported"
+
+    def format(**kwargs: str) -> str:
+        return "".join(
+            literal + (kwargs[field] if field is not None else "")
+            for literal, field, _, _ in parts
+        )
+
+    return format
+
+
+_format_user_prompt = _compile_template(CC_USER_PROMPT_TEMPLATE)
+_format_user_prompt_with_feedback = _compile_template(
+    CC_USER_PROMPT_TEMPLATE_WITH_FEEDBACK
+)
+_format_insights = _compile_template(DEFAULT_INSIGHTS_TEMPLATE)
+_format_failed_patch = _compile_template(FAILED_PATCH_TEMPLATE)
+
+# Actions whose diff is fed back to the next iteration. All of them are leaf
+# classes, so the exact type can be looked up.
+_FAILED_ACTION_TYPES: frozenset[type[Action]] = frozenset(
+    {
+        VulnerableDiffAction,
+        CompilableDiffAction,
+        UncompilableDiffAction,
+        WrongDiffAction,
+    }
+)
+
+
 class CCAgent(AgentProtocol):
     """Agent using Claude Agent SDK (Python) instead of CLI binary."""
 
@@ -85,80 +122,145 @@ class CCAgent(AgentProtocol):
 
         self.llm_cost: float = 0.0
 
+        # The event loop is reused by every act() call, along with the default
+        # executor used for blocking steps.
+        self._runner = asyncio.Runner()
+        weakref.finalize(self, self._runner.close)
+
     def act(self, context: AgentContext, detection: Detection) -> Iterator[Action]:
+        yield self._runner.run(self._act(context, detection))
+
+    async def _act(self, context: AgentContext, detection: Detection) -> Action:
         output_directory = (
             context["output_directory"] if "output_directory" in context else None
         )
 
-        failed_patches = ""
+        failed_patches: list[str] = []
 
         actions: list[Action] = []
 
-        for context in _iterate_with_output_directory(
-            context, output_directory, self._max_iterations
-        ):
-            coder = CCCoder(
-                max_turns=self._max_turns, max_budget_usd=self._max_budget_usd
-            )
-            coder._agent_context = context
-
-            prompt = make_prompt(context, detection, failed_patches)
-            diff = coder.run(context, prompt)
-
-            action: Action
-            if diff is None or len(diff.strip()) == 0:
-                action = NoPatchAction()
-            else:
-                action = context["evaluator"].evaluate(context, diff, detection)
-
-            store_debug_file(context, "prompt.txt", prompt)
-            store_debug_file(
-                context,
-                "diff.txt",
-                diff.decode(errors="replace") if diff is not None else "",
-            )
-
-            actions.append(action)
-
-            if isinstance(
-                action,
-                (
-                    VulnerableDiffAction,
-                    CompilableDiffAction,
-                    UncompilableDiffAction,
-                    WrongDiffAction,
-                ),
+        debug_writes: list[asyncio.Task[None]] = []
+
+        # Both only depend on the detection, so they are computed once instead of
+        # on every iteration. Running the PoV overlaps with the SDK startup.
+        crash_analysis_task = asyncio.create_task(
+            asyncio.to_thread(_analyze_crash, context, detection)
+        )
+
+        # A single session is shared by all iterations so that the SDK subprocess
+        # is only started once.
+        coder = CCCoder(max_turns=self._max_turns, max_budget_usd=self._max_budget_usd)
+        coder._agent_context = context
+
+        llm_cost = self.llm_cost
+
+        async with coder:
+            # The coder restores the source directory after each iteration, so it
+            # only needs to be cleaned up once beforehand. Running the PoV may
+            # load the environment into the same directory, so it is restored
+            # only after the PoV is done.
+            crash_log, bug_class = await crash_analysis_task
+            await coder.restore()
+            if crash_log is None:
+                # Without a crash log (and without failed patches, as this is
+                # before the first iteration) the prompt has nothing to act on.
+                context["logger"].warning(
+                    "Failed to generate crash log, skipping Claude Agent SDK"
+                )
+                return NoPatchAction()
+
+            for context in _iterate_with_output_directory(
+                context, output_directory, self._max_iterations
             ):
-                failed_patches += FAILED_PATCH_TEMPLATE.format(
-                    failed_patch=diff.decode(errors="replace")
-                    if diff is not None
-                    else ""
+                cached_prompt, prompt = make_prompt(
+                    bug_class, crash_log, "".join(failed_patches)
                 )
-            else:
-                break
+                diff = await coder.send(context, prompt, cached_prompt=cached_prompt)
+                self.llm_cost = llm_cost + coder.total_cost_usd
 
-        yield choose_best_action(actions)
+                # The debug files are written in the background while the diff is
+                # evaluated. The context is copied as its output directory changes
+                # with every iteration.
+                debug_writes.append(
+                    asyncio.create_task(
+                        asyncio.to_thread(
+                            store_debug_files,
+                            context.copy(),
+                            {
+                                "prompt.txt": "\n\n".join(
+                                    filter(None, [cached_prompt, prompt])
+                                ),
+                                "diff.txt": diff.decode(errors="replace")
+                                if diff is not None
+                                else "",
+                            },
+                        )
+                    )
+                )
 
+                action: Action
+                if diff is None or len(diff.strip()) == 0:
+                    action = NoPatchAction()
+                else:
+                    action = await asyncio.to_thread(
+                        context["evaluator"].evaluate, context, diff, detection
+                    )
 
-def make_prompt(
-    context: AgentContext, detection: Detection, failed_patches: str
-) -> str:
-    bug_class = get_bug_class(context, detection) or ""
+                actions.append(action)
+
+                if type(action) in _FAILED_ACTION_TYPES:
+                    failed_patches.append(
+                        _format_failed_patch(
+                            failed_patch=diff.decode(errors="replace")
+                            if diff is not None
+                            else ""
+                        )
+                    )
+                else:
+                    break
+
+                if self._is_budget_exhausted(coder.total_cost_usd, len(actions)):
+                    context["logger"].info("LLM budget is exhausted, stop retrying")
+                    break
+
+        await asyncio.gather(*debug_writes)
 
-    crash_log = CrashLogInsighter().create(context, detection)
+        return choose_best_action(actions)
+
+    def _is_budget_exhausted(self, cost: float, iterations: int) -> bool:
+        # Another iteration is expected to cost as much as the previous ones on
+        # average, so do not start it if it would exceed the budget anyway.
+        remaining = self._max_budget_usd - cost
+        return remaining <= 0 or remaining < cost / iterations
+
+
+def _analyze_crash(
+    context: AgentContext, detection: Detection
+) -> tuple[str | None, str]:
+    """Returns the crash log and the bug class of the detection."""
+    if (crash_log := CrashLogInsighter().create(context, detection)) is None:
+        return None, ""
+
+    # The PoV output is in the context's memory by now, so the PoV is not run again
+    return crash_log, get_bug_class(context, detection) or ""
+
+
+def make_prompt(
+    bug_class: str, crash_log: str | None, failed_patches: str
+) -> tuple[str, str]:
+    """Returns the static (cacheable) and the dynamic parts of the prompt."""
     if crash_log is None:
-        context["logger"].warning("Failed to generate crash log")
         insights = ""
     else:
-        insights = DEFAULT_INSIGHTS_TEMPLATE.format(crash_log=crash_log)
+        insights = _format_insights(crash_log=crash_log)
+
+    cached_prompt = _format_user_prompt(bug_class=bug_class, insights=insights)
 
     if failed_patches == "":
-        return CC_USER_PROMPT_TEMPLATE.format(
-            bug_class=bug_class, insights=insights
-        )
+        return cached_prompt, ""
     else:
-        return CC_USER_PROMPT_TEMPLATE_WITH_FEEDBACK.format(
-            bug_class=bug_class, insights=insights, failed_patch=failed_patches
+        return cached_prompt, _format_user_prompt_with_feedback(
+            failed_patch=failed_patches
         )
 
 
@@ -1,9 +1,13 @@
 """CC Coder - Uses Claude Agent SDK (Python) instead of CLI binary."""
 import asyncio
-import subprocess
+import hashlib
+import os
+from contextlib import ExitStack
 from pathlib import Path
+from types import TracebackType
+from typing import Any, AsyncIterator, Self, TextIO
 
-from claude_agent_sdk import query
+from claude_agent_sdk import ClaudeSDKClient
 from claude_agent_sdk.types import (
     ClaudeAgentOptions,
     AssistantMessage,
@@ -11,108 +15,247 @@ from claude_agent_sdk.types import (
     TextBlock,
     ToolUseBlock,
 )
+from pygit2 import Repository
 
-from python_file_system.directory.context_managers import changed_directory
-
-from crete.commons.interaction.functions import run_command
-from crete.framework.agent.functions import store_debug_file
+from crete.atoms.path import DEFAULT_CACHE_DIRECTORY
+from crete.commons.interaction.exceptions import CommandInteractionError
 from crete.framework.coder.contexts import CoderContext
 from crete.framework.coder.protocols import CoderProtocol
 
+CC_MODEL = "claude-sonnet-4-5-20250929"
+
+# Diffs are cached by prompt and source revision when CC_RESPONSE_CACHE=true,
+# which is meant for reruns of the same detections during development.
+_RESPONSE_CACHE_DIRECTORY = DEFAULT_CACHE_DIRECTORY / "cc"
+
 
 class CCCoder(CoderProtocol):
-    """Coder that uses Claude Agent SDK for Python."""
+    """Coder that uses Claude Agent SDK for Python.
+
+    The coder can be used as an async context manager to keep a single Claude
+    Agent SDK session alive across several `send` calls, which avoids paying
+    the SDK subprocess startup for every retry.
+    """
 
     def __init__(self, max_turns: int = 100, max_budget_usd: float = 5.0):
         self.max_turns = max_turns
         self.max_budget_usd = max_budget_usd
 
-    def run(self, context: CoderContext, prompt: str) -> bytes | None:
-        """Run Claude Agent SDK to generate a fix."""
-        with changed_directory(self._agent_context["pool"].source_directory):
-            # Restore to clean state
-            run_command(("git restore --source=HEAD :/", Path(".")))
-
-            # Run async agent
-            diff = asyncio.run(self._run_agent_async(context, prompt))
+        # Cost reported by the SDK for the current session so far
+        self.total_cost_usd: float = 0.0
 
-            if diff is None:
-                return None
+        self._client: ClaudeSDKClient | None = None
+        self._sent_cached_prompt: str | None = None
+        self._repository: Repository | None = None
+        self._use_response_cache = os.getenv("CC_RESPONSE_CACHE", "") == "true"
 
-            return diff.encode()
-
-    async def _run_agent_async(self, context: CoderContext, prompt: str) -> str | None:
-        """Run the Claude Agent SDK asynchronously."""
+    async def __aenter__(self) -> Self:
         source_dir = self._agent_context["pool"].source_directory
 
         # Configure Claude Agent options
         options = ClaudeAgentOptions(
-            model="claude-sonnet-4-5-20250929",
+            model=CC_MODEL,
             cwd=str(source_dir),
             permission_mode="bypassPermissions",  # Auto-accept all tools
             max_turns=self.max_turns,
             max_budget_usd=self.max_budget_usd,
         )
 
-        messages = []
-        assistant_responses = []
+        self._client = ClaudeSDKClient(options=options)
+        await self._client.connect()
+        self._sent_cached_prompt = None
+        self.total_cost_usd = 0.0
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        assert self._client is not None, "Session is not started"
+        try:
+            await self._client.disconnect()
+        finally:
+            self._client = None
+
+    def run(
+        self, context: CoderContext, prompt: str, cached_prompt: str = ""
+    ) -> bytes | None:
+        """Run Claude Agent SDK to generate a fix in a one-off session.
+
+        `cached_prompt` is sent ahead of `prompt`, so it should only contain text
+        that is stable across runs for the prefix to be reused from the cache.
+        """
+
+        async def _run() -> bytes | None:
+            async with self:
+                await self.restore()
+                return await self.send(context, prompt, cached_prompt)
+
+        return asyncio.run(_run())
+
+    async def send(
+        self, context: CoderContext, prompt: str, cached_prompt: str = ""
+    ) -> bytes | None:
+        """Send a prompt to the running session and return the resulting diff.
+
+        The source directory is expected to be clean, see `restore`, and is
+        restored again once the diff is taken.
+        `cached_prompt` is only sent if the session has not received it yet.
+        """
+        assert self._client is not None, "Session is not started"
+
+        cache_file = None
+        if self._use_response_cache:
+            cache_file = self._response_cache_file(prompt, cached_prompt)
+            if cache_file is not None and cache_file.exists():
+                context["logger"].info(f"Using cached response: {cache_file}")
+                return cache_file.read_bytes()
+
+        if cached_prompt == self._sent_cached_prompt:
+            cached_prompt = ""
 
         try:
-            # Run the agent
-            async for message in query(prompt=prompt, options=options):
-                messages.append(message)
-
-                # Log the message
-                if isinstance(message, AssistantMessage):
-                    for block in message.content:
-                        if isinstance(block, TextBlock):
-                            context["logger"].debug(f"Assistant: {block.text[:200]}...")
-                            assistant_responses.append(block.text)
-                        elif isinstance(block, ToolUseBlock):
-                            context["logger"].debug(f"Tool use: {block.name}")
-
-        except Exception as e:
-            context["logger"].error(f"Error running Claude Agent SDK: {e}")
+            diff = await self._run_agent_async(context, prompt, cached_prompt)
+        finally:
+            await self.restore()
+
+        if diff is None:
             return None
 
-        # Save debug files
-        if "output_directory" in context:
-            # Save all messages
-            messages_file = context["output_directory"] / "cc_messages.txt"
-            with open(messages_file, "w") as f:
-                for i, msg in enumerate(messages):
-                    f.write(f"\n{'='*80}\n")
-                    f.write(f"Message {i}: {type(msg).__name__}\n")
-                    f.write(f"{'='*80}\n")
-                    f.write(f"{msg}\n")
-
-            # Save assistant responses
-            responses_file = context["output_directory"] / "cc_responses.txt"
-            with open(responses_file, "w") as f:
-                for i, response in enumerate(assistant_responses):
-                    f.write(f"\n{'='*80}\n")
-                    f.write(f"Response {i+1}\n")
-                    f.write(f"{'='*80}\n")
-                    f.write(f"{response}\n")
+        if cache_file is not None:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            cache_file.write_bytes(diff.encode())
 
-        # Get git diff
-        diff = self._get_git_diff(source_dir)
+        return diff.encode()
+
+    async def restore(self) -> None:
+        """Restore the source directory to a clean state."""
+        process = await asyncio.create_subprocess_exec(
+            "git",
+            "restore",
+            "--source=HEAD",
+            ":/",
+            cwd=self._agent_context["pool"].source_directory,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await process.communicate()
+        if process.returncode != 0:
+            raise CommandInteractionError(
+                stdout=stdout, stderr=stderr, return_code=process.returncode or 1
+            )
+
+    async def _run_agent_async(
+        self, context: CoderContext, prompt: str, cached_prompt: str
+    ) -> str | None:
+        """Run the Claude Agent SDK asynchronously."""
+        assert self._client is not None, "Session is not started"
+        source_dir = self._agent_context["pool"].source_directory
+
+        with ExitStack() as stack:
+            # Debug files are written as messages arrive instead of keeping the
+            # whole transcript in memory.
+            messages_file: TextIO | None = None
+            responses_file: TextIO | None = None
+            if "output_directory" in context:
+                messages_file = stack.enter_context(
+                    open(context["output_directory"] / "cc_messages.txt", "w")
+                )
+                responses_file = stack.enter_context(
+                    open(context["output_directory"] / "cc_responses.txt", "w")
+                )
+
+            try:
+                # Run the agent
+                await self._client.query(_user_messages(prompt, cached_prompt))
+                if cached_prompt:
+                    self._sent_cached_prompt = cached_prompt
 
-        # Restore to clean state
-        run_command(("git restore --source=HEAD :/", Path(".")))
+                n_messages = 0
+                n_responses = 0
+                async for message in self._client.receive_response():
+                    if messages_file is not None:
+                        _write_entry(
+                            messages_file,
+                            f"Message {n_messages}: {type(message).__name__}",
+                            message,
+                        )
+                    n_messages += 1
 
-        return diff
+                    # Log the message
+                    if isinstance(message, AssistantMessage):
+                        for block in message.content:
+                            if isinstance(block, TextBlock):
+                                context["logger"].debug(
+                                    f"Assistant: {block.text[:200]}..."
+                                )
+                                n_responses += 1
+                                if responses_file is not None:
+                                    _write_entry(
+                                        responses_file,
+                                        f"Response {n_responses}",
+                                        block.text,
+                                    )
+                            elif isinstance(block, ToolUseBlock):
+                                context["logger"].debug(f"Tool use: {block.name}")
+                    elif isinstance(message, ResultMessage):
+                        if message.total_cost_usd is not None:
+                            self.total_cost_usd = message.total_cost_usd
+
+            except Exception as e:
+                context["logger"].error(f"Error running Claude Agent SDK: {e}")
+                return None
+
+        # Get git diff
+        return self._get_git_diff(source_dir)
 
     def _get_git_diff(self, project_dir: Path) -> str | None:
-        """Get git diff from the project directory."""
+        """Get git diff of the working tree against the index."""
         try:
-            result = subprocess.run(
-                ["git", "diff"],
-                cwd=project_dir,
-                capture_output=True,
-                text=True,
-                check=True,
-            )
-            return result.stdout
-        except Exception as e:
+            return self._get_repository(project_dir).diff().patch or ""
+        except Exception:
             return None
+
+    def _get_repository(self, project_dir: Path) -> Repository:
+        if self._repository is None:
+            self._repository = Repository(str(project_dir))
+        return self._repository
+
+    def _response_cache_file(self, prompt: str, cached_prompt: str) -> Path | None:
+        source_dir = self._agent_context["pool"].source_directory
+        try:
+            head = str(self._get_repository(source_dir).head.target)
+        except Exception:
+            return None
+
+        key = hashlib.sha256()
+        for part in (CC_MODEL, cached_prompt, prompt, head):
+            key.update(part.encode())
+            key.update(b"\0")
+        return _RESPONSE_CACHE_DIRECTORY / f"{key.hexdigest()}.diff"
+
+
+def _write_entry(file: TextIO, title: str, body: object) -> None:
+    file.write(f"\n{'='*80}\n")
+    file.write(f"{title}\n")
+    file.write(f"{'='*80}\n")
+    file.write(f"{body}\n")
+
+
+async def _user_messages(
+    prompt: str, cached_prompt: str
+) -> AsyncIterator[dict[str, Any]]:
+    content: list[dict[str, Any]] = []
+    if cached_prompt:
+        content.append({"type": "text", "text": cached_prompt})
+    if prompt:
+        content.append({"type": "text", "text": prompt})
+
+    yield {
+        "type": "user",
+        "message": {"role": "user", "content": content},
+        "parent_tool_use_id": None,
+        "session_id": "default",
+    }
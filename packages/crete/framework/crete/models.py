@@ -49,24 +49,24 @@ class Crete:
         }
         from crete.framework.scheduler.tracker import LlmCostTracker
 
-        tracker = LlmCostTracker(llm_cost_limit, block_llm=True)
-        tracker.start()
-        for agent in self.scheduler.schedule(scheduling_context, self.agents):
-            assert agent in actions_by_agent, "Agent should be in the queue"
+        with LlmCostTracker(llm_cost_limit, block_llm=True) as tracker:
+            for agent in self.scheduler.schedule(scheduling_context, self.agents):
+                assert agent in actions_by_agent, "Agent should be in the queue"
 
-            actions = actions_by_agent[agent]
+                actions = actions_by_agent[agent]
 
-            assert len(actions) >= 1, "Actions should not be empty"
+                assert len(actions) >= 1, "Actions should not be empty"
 
-            context, detection = context_builder.build(
-                previous_action=HeadAction(),  # FIXME: Re-enable reflection
-                reflection=self.reflector.reflect(actions) if self.reflector else None,
-            )
+                context, detection = context_builder.build(
+                    previous_action=HeadAction(),  # FIXME: Re-enable reflection
+                    reflection=self.reflector.reflect(actions)
+                    if self.reflector
+                    else None,
+                )
 
-            action = _run_agent(agent, context, detection)
-            self.scheduler.feedback(agent, action)
-            actions_by_agent[agent].append(action)
-        tracker.stop()
+                action = _run_agent(agent, context, detection)
+                self.scheduler.feedback(agent, action)
+                actions_by_agent[agent].append(action)
 
         actions = [
             action for actions in actions_by_agent.values() for action in actions
@@ -36,7 +36,9 @@ class RoundRobinScheduler(SchedulerProtocol):
                         self._logger.info("Resource limit reached, exiting")
                         return
 
+                    llm_cost = _reported_llm_cost(agent)
                     yield agent
+                    tracker.add_llm_cost(_reported_llm_cost(agent) - llm_cost)
 
     def feedback(self, agent: AgentProtocol, action: Action):
         self._last_action = action
@@ -47,3 +49,9 @@ class RoundRobinScheduler(SchedulerProtocol):
             and self._last_action is not None
             and isinstance(self._last_action, SoundDiffAction)
         )
+
+
+def _reported_llm_cost(agent: AgentProtocol) -> float:
+    # Agents that do not call LLMs through litellm (e.g. CCAgent) are invisible
+    # to the cost tracker, so they report their cost themselves.
+    return getattr(agent, "llm_cost", 0.0)
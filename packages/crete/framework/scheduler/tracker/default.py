@@ -5,14 +5,18 @@ from crete.framework.scheduler.tracker.time import TimeTracker
 
 class DefaultTracker(TrackerProtocol):
     def __init__(self, max_time: float, max_cost: float) -> None:
+        self._llm_cost_tracker = LlmCostTracker(max_cost)
         self._trackers = [
             TimeTracker(max_time),
-            LlmCostTracker(max_cost),
+            self._llm_cost_tracker,
         ]
 
     def is_exhausted(self) -> bool:
         return any(tracker.is_exhausted() for tracker in self._trackers)
 
+    def add_llm_cost(self, cost: float) -> None:
+        self._llm_cost_tracker.add_cost(cost)
+
     def start(self) -> None:
         for tracker in self._trackers:
             tracker.start()
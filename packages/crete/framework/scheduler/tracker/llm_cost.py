@@ -1,10 +1,15 @@
-from typing import Any, Callable, TypeAlias, Union
+import functools
+import re
+import sys
+import threading
+from types import TracebackType
+from typing import Any, Callable, Self, TypeAlias, Union
 
 import litellm
 from litellm import CustomStreamWrapper
 from litellm.types.utils import ModelResponse
 
-from crete.framework.scheduler.tracker.models import LlmUsage
+from crete.framework.scheduler.tracker.models import LlmUsage, micro_dollars
 from crete.framework.scheduler.tracker.protocols import TrackerProtocol
 
 # Define a type alias for the completion function
@@ -13,51 +18,139 @@ CompletionCallable: TypeAlias = Callable[..., Union[ModelResponse, CustomStreamW
 
 class LlmCostTracker(TrackerProtocol):
     def __init__(self, max_cost: float, block_llm: bool = False) -> None:
-        self._max_cost = max_cost
+        self._max_cost_micro = micro_dollars(max_cost)
         self._total_usage: LlmUsage = LlmUsage()
         self._current_usage: LlmUsage = LlmUsage()
-        self._original_completion: CompletionCallable
         self._block_llm = block_llm
 
+    def __enter__(self) -> Self:
+        self.start()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        self.stop()
+
     def is_exhausted(self) -> bool:
-        return self._total_usage.total_cost >= self._max_cost
+        return self._total_usage.total_cost_micro >= self._max_cost_micro
+
+    def add_cost(self, cost: float) -> None:
+        """Account for LLM calls that do not go through litellm."""
+        with _lock:
+            self._total_usage.total_cost_micro += micro_dollars(cost)
 
     def start(self) -> None:
-        self._original_completion = litellm.completion  # pyright: ignore[reportUnknownMemberType]
-        litellm.completion = self._tracking_completion
+        global _original_completion
+        with _lock:
+            if not _active_trackers:
+                _original_completion = litellm.completion  # pyright: ignore[reportUnknownMemberType]
+                litellm.completion = LlmCostTracker._tracking_completion
+            _active_trackers.append(self)
 
     def stop(self) -> None:
-        litellm.completion = self._original_completion
-
+        with _lock:
+            if self not in _active_trackers:
+                return
+            _active_trackers.remove(self)
+            if not _active_trackers:
+                assert _original_completion is not None, "Unreachable code"
+                litellm.completion = _original_completion
+
+    @staticmethod
     def _tracking_completion(
-        self, *args: Any, **kwargs: Any
+        *args: Any, **kwargs: Any
     ) -> Union[ModelResponse, CustomStreamWrapper]:
-        if self._block_llm and self.is_exhausted():
-            raise Exception(f"{__class__.__name__}: LLM cost limit exceeded, aborting")
-        response = self._original_completion(*args, **kwargs)
-        self._update_usage(response)
-        return response
-
-    def _update_usage(
-        self, response: Union[ModelResponse, CustomStreamWrapper]
-    ) -> None:
+        with _lock:
+            trackers = list(_active_trackers)
+            completion = _original_completion
+        assert completion is not None, "Unreachable code"
+
+        for tracker in trackers:
+            if tracker._block_llm and tracker.is_exhausted():
+                raise Exception(
+                    f"{__class__.__name__}: LLM cost limit exceeded, aborting"
+                )
+
+        response = completion(*args, **kwargs)
         if not isinstance(response, ModelResponse):
-            return
+            return response
 
         try:
-            self._current_usage = _litellm_usage_from_response(response)
-            self._total_usage += self._current_usage
+            usage = _litellm_usage_from_response(response)
         except Exception:
-            return
+            return response
+
+        with _lock:
+            for tracker in trackers:
+                tracker._current_usage = usage
+                tracker._total_usage += usage
+        return response
+
+
+# All running trackers share a single wrapper around `litellm.completion`, so
+# nested or concurrent trackers do not end up wrapping each other.
+_lock = threading.Lock()
+_active_trackers: list[LlmCostTracker] = []
+_original_completion: CompletionCallable | None = None
+
+
+# Cost map keys of the tiered rates, e.g. `input_cost_per_token_above_128k_tokens`
+_TIER_KEY_PATTERN = re.compile(r"_above_(\d+)k_tokens$")
 
 
 def _litellm_cost_from_usage(model: str, usage: LlmUsage) -> float:
+    if usage.prompt_tokens > _litellm_lowest_tier_threshold(model):
+        # Above a tier the rates depend on the prompt size, so litellm prices
+        # the call exactly.
+        prompt_cost, completion_cost = litellm.cost_per_token(  # pyright: ignore[reportUnknownMemberType, reportPrivateImportUsage]
+            model=model,
+            prompt_tokens=usage.prompt_tokens,
+            completion_tokens=usage.completion_tokens,
+        )
+        return prompt_cost + completion_cost
+
+    prompt_rate, completion_rate = _litellm_base_rates(model)
+    return usage.prompt_tokens * prompt_rate + usage.completion_tokens * completion_rate
+
+
+@functools.lru_cache(maxsize=64)
+def _litellm_lowest_tier_threshold(model: str) -> int:
+    """Returns the prompt size above which the model has other rates.
+
+    It is `sys.maxsize` if the model has a single tier, and 0 if litellm does
+    not know the model, so that every call is priced by litellm itself.
+    """
+    try:
+        model_info = litellm.get_model_info(model)  # pyright: ignore[reportUnknownMemberType, reportPrivateImportUsage]
+    except Exception:
+        return 0
+
+    # The model info lists every tier key, with `None` for tiers the model
+    # does not have.
+    thresholds = [
+        int(match.group(1)) * 1_000
+        for key, value in model_info.items()
+        if value is not None and (match := _TIER_KEY_PATTERN.search(key)) is not None
+    ]
+    return min(thresholds, default=sys.maxsize)
+
+
+@functools.lru_cache(maxsize=64)
+def _litellm_base_rates(model: str) -> tuple[float, float]:
+    # The per-token rates below the lowest tier are constant, so the pricing
+    # table is only looked up once per model.
+    prompt_tokens = 1_000
+    completion_tokens = 1_000
     prompt_cost, completion_cost = litellm.cost_per_token(  # pyright: ignore[reportUnknownMemberType, reportPrivateImportUsage]
         model=model,
-        prompt_tokens=usage.prompt_tokens,
-        completion_tokens=usage.completion_tokens,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
     )
-    return prompt_cost + completion_cost
+    return prompt_cost / prompt_tokens, completion_cost / completion_tokens
 
 
 def _litellm_usage_from_response(response: ModelResponse) -> LlmUsage:
@@ -1,21 +1,35 @@
 from dataclasses import dataclass
 
 
-@dataclass
+def micro_dollars(cost: float) -> int:
+    return round(cost * 1_000_000)
+
+
+@dataclass(slots=True)
 class LlmUsage:
-    total_cost: float = 0.0
+    # The cost is stored in integer micro-dollars so that summing up many small
+    # costs does not accumulate rounding errors.
+    total_cost_micro: int = 0
     prompt_tokens: int = 0
     completion_tokens: int = 0
 
+    @property
+    def total_cost(self) -> float:
+        return self.total_cost_micro / 1_000_000
+
+    @total_cost.setter
+    def total_cost(self, cost: float) -> None:
+        self.total_cost_micro = micro_dollars(cost)
+
     def __add__(self, other: "LlmUsage") -> "LlmUsage":
         return LlmUsage(
-            total_cost=self.total_cost + other.total_cost,
+            total_cost_micro=self.total_cost_micro + other.total_cost_micro,
             prompt_tokens=self.prompt_tokens + other.prompt_tokens,
             completion_tokens=self.completion_tokens + other.completion_tokens,
         )
 
     def __iadd__(self, other: "LlmUsage") -> "LlmUsage":
-        self.total_cost += other.total_cost
+        self.total_cost_micro += other.total_cost_micro
         self.prompt_tokens += other.prompt_tokens
         self.completion_tokens += other.completion_tokens
         return self
\ No newline at end of file
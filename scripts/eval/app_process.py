@@ -0,0 +1,105 @@
+import atexit
+import multiprocessing
+import os
+import runpy
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT_DIRECTORY = Path(__file__).parent.parent.parent
+
+# The forkserver imports these once, so each detection does not pay for
+# importing the third-party dependencies of the apps again.
+_PRELOAD_MODULES = [
+    "__main__",
+    "pydantic",
+    "pygit2",
+    "litellm",
+    "langchain_core",
+    "claude_agent_sdk",
+]
+
+_context = multiprocessing.get_context("forkserver")
+_context.set_forkserver_preload(_PRELOAD_MODULES)
+
+
+def run_app_process(
+    app_module: str,
+    args: list[str],
+    env: dict[str, str],
+    stdout_path: Path,
+    stderr_path: Path,
+    timeout: int,
+):
+    """Run `python -m app_module *args` in a child of a warm forkserver.
+
+    `env` only holds the variables to set on top of the inherited environment.
+
+    Raises the same exceptions as `subprocess.run(..., check=True, timeout=...)`.
+    """
+    cmd = ["python", "-m", app_module, *args]
+    process = _context.Process(
+        target=_run_app,
+        args=(app_module, args, env, stdout_path, stderr_path),
+    )
+    process.start()
+    process.join(timeout)
+
+    if process.is_alive():
+        process.kill()
+        process.join()
+        raise subprocess.TimeoutExpired(cmd, timeout)
+
+    if process.exitcode != 0:
+        raise subprocess.CalledProcessError(process.exitcode or 1, cmd)
+
+
+def _run_app(
+    app_module: str,
+    args: list[str],
+    env: dict[str, str],
+    stdout_path: Path,
+    stderr_path: Path,
+):
+    os.environ.update(env)
+    # Our packages read the environment at import time (e.g. `CACHE_DIRECTORY`
+    # and `OSS_FUZZ_DIRECTORY`), so they are imported again from scratch.
+    _unload_first_party_modules()
+
+    # Redirect the file descriptors so that subprocesses of the app are captured
+    for path, target_fd in (
+        (stdout_path, sys.stdout.fileno()),
+        (stderr_path, sys.stderr.fileno()),
+    ):
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.dup2(fd, target_fd)
+        finally:
+            os.close(fd)
+
+    sys.argv = [app_module, *args]
+    try:
+        runpy.run_module(app_module, run_name="__main__", alter_sys=True)
+    finally:
+        # The child ends with `os._exit`, so the `atexit` handlers of the app,
+        # e.g. log flushes, are run here as they would be under `python -m`.
+        atexit._run_exitfuncs()  # pyright: ignore[reportAttributeAccessIssue]
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
+def _unload_first_party_modules():
+    prefix = Path(sys.prefix).resolve()
+    for name, module in list(sys.modules.items()):
+        if name == "__main__":
+            continue
+
+        module_file = getattr(module, "__file__", None)
+        if module_file is None:
+            continue
+
+        module_path = Path(module_file).resolve()
+        if module_path.is_relative_to(ROOT_DIRECTORY.resolve()) and (
+            not module_path.is_relative_to(prefix)
+        ):
+            del sys.modules[name]
@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 import argparse
-import json
 import os
 import sys
 
+import orjson
+
 variant_values = [
     "sound",
     "vulnerable",
@@ -34,8 +35,8 @@ def change_variant(input_file: str, cpv_name: str, new_variant: str) -> bool:
 
     try:
         # Read the input JSON file
-        with open(input_file, "r") as f:
-            data = json.load(f)
+        with open(input_file, "rb") as f:
+            data = orjson.loads(f.read())
 
         # Check if the file has the expected structure
         if "results" not in data:
@@ -58,21 +59,16 @@ def change_variant(input_file: str, cpv_name: str, new_variant: str) -> bool:
 
         # Update statistics if they exist
         if "statistics" in data:
-            # Create a dictionary to count variants
-            variant_counts = {}
-            for result in data["results"]:
-                variant = result.get("variant")
-                if variant:
-                    variant_counts[variant] = variant_counts.get(variant, 0) + 1
-
-            # Update statistics
-            data["statistics"] = [
-                [variant, count] for variant, count in variant_counts.items()
-            ]
+            statistics = _updated_statistics(
+                data["statistics"], old_variant, new_variant
+            )
+            if statistics is None:
+                statistics = _count_variants(data["results"])
+            data["statistics"] = statistics
 
         # Write the updated data back to the file
-        with open(input_file, "w") as f:
-            json.dump(data, f, indent=2)
+        with open(input_file, "wb") as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
 
         print(f"Successfully updated {input_file}")
         return True
@@ -82,6 +78,48 @@ def change_variant(input_file: str, cpv_name: str, new_variant: str) -> bool:
         return False
 
 
+def _updated_statistics(
+    statistics: object, old_variant: str, new_variant: str
+) -> list[list[str | int]] | None:
+    """
+    Move one count from old_variant to new_variant in the statistics.
+
+    Returns:
+        list | None: The updated statistics, or None if they do not have the
+            expected `[[variant, count], ...]` structure
+    """
+    if not isinstance(statistics, list):
+        return None
+
+    variant_counts: dict[str, int] = {}
+    for entry in statistics:
+        if not (isinstance(entry, list) and len(entry) == 2):
+            return None
+        variant, count = entry
+        if not (isinstance(variant, str) and isinstance(count, int)):
+            return None
+        variant_counts[variant] = count
+
+    if variant_counts.get(old_variant, 0) <= 0:
+        return None
+
+    variant_counts[old_variant] -= 1
+    variant_counts[new_variant] = variant_counts.get(new_variant, 0) + 1
+
+    return [[variant, count] for variant, count in variant_counts.items() if count > 0]
+
+
+def _count_variants(results: list[dict[str, object]]) -> list[list[str | int]]:
+    # Create a dictionary to count variants
+    variant_counts: dict[str, int] = {}
+    for result in results:
+        variant = result.get("variant")
+        if isinstance(variant, str) and variant:
+            variant_counts[variant] = variant_counts.get(variant, 0) + 1
+
+    return [[variant, count] for variant, count in variant_counts.items()]
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Change variant value for a specific CPV name in a JSON result file"
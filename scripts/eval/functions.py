@@ -1,5 +1,6 @@
 import logging
 import os
+import shlex
 import subprocess
 from pathlib import Path
 from typing import Literal, Optional
@@ -62,24 +63,23 @@ def init_environment_pool(
 def construct_challenge_mode(
     challenge_project_directory: Path, mode: Literal["full", "delta"]
 ) -> AIxCCChallengeMode:
-    def run_git_command(cmd: str) -> str:
+    def run_git_command(cmd: list[str]) -> str:
         try:
             return subprocess.check_output(
                 cmd,
                 cwd=challenge_project_directory,
-                shell=True,
                 text=True,
                 stderr=subprocess.STDOUT,
             ).strip()
         except subprocess.CalledProcessError as e:
-            print(f"Error running command: {cmd}")
+            print(f"Error running command: {shlex.join(cmd)}")
             print(f"Return code: {e.returncode}")
             print(f"Output:\n{e.output}")
             raise
 
     match mode:
         case "full":
-            base_ref = run_git_command("git rev-parse HEAD")
+            base_ref = run_git_command(["git", "rev-parse", "HEAD"])
             challenge_mode = AIxCCChallengeFullMode.model_validate(
                 {
                     "type": "full",
@@ -87,8 +87,8 @@ def construct_challenge_mode(
                 }
             )
         case "delta":
-            base_ref = run_git_command("git rev-parse HEAD~")
-            delta_ref = run_git_command("git rev-parse HEAD")
+            base_ref = run_git_command(["git", "rev-parse", "HEAD~"])
+            delta_ref = run_git_command(["git", "rev-parse", "HEAD"])
             challenge_mode = AIxCCChallengeDeltaMode.model_validate(
                 {
                     "type": "delta",
@@ -99,39 +99,48 @@ def construct_challenge_mode(
     return challenge_mode
 
 
-def run_command(command: str, env: dict[str, str] = {}):
+def run_command(command: list[str], env: dict[str, str] = {}):
     try:
         subprocess.run(
             command,
             check=True,
-            shell=True,
             capture_output=True,
             text=True,
-            env={
-                **os.environ,
-                **env,
-            },
+            env={**os.environ, **env} if env else None,
         )
     except subprocess.CalledProcessError as e:
-        print(f"Command failed: {command}")
+        print(f"Command failed: {shlex.join(command)}")
         print(f"Return code: {e.returncode}")
         print(f"stderr:\n{e.stderr}")
         raise
 
 
+# Images that are known to exist, as the same project is built for many detections
+_built_oss_fuzz_images: set[str] = set()
+
+
 def build_oss_fuzz_image(
     project_name: str,
     oss_fuzz_directory: Path,
 ):
-    try:
-        run_command(f"docker inspect aixcc-afc/{project_name}")
+    image = f"aixcc-afc/{project_name}"
+    if image in _built_oss_fuzz_images:
         return
+
+    try:
+        run_command(["docker", "inspect", image])
     except Exception:
-        pass
+        run_command(
+            [
+                "python",
+                str(oss_fuzz_directory / "infra" / "helper.py"),
+                "build_image",
+                "--no-pull",
+                project_name,
+            ]
+        )
 
-    run_command(
-        f"python {oss_fuzz_directory}/infra/helper.py build_image --no-pull {project_name}"
-    )
+    _built_oss_fuzz_images.add(image)
 
 
 def make_crete_environments_cache(
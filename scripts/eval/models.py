@@ -1,10 +1,16 @@
-import re
 from typing import Annotated, Any, Optional
 
 from pydantic import BaseModel, BeforeValidator
 
+_HEX_DIGITS = frozenset("0123456789abcdef")
+
 CommitHexString = Annotated[
-    str, BeforeValidator(lambda x: x if re.match(r"^[a-f0-9]{40}$", x) else None)
+    str,
+    BeforeValidator(
+        lambda x: x
+        if isinstance(x, str) and len(x) == 40 and _HEX_DIGITS.issuperset(x)
+        else None
+    ),
 ]
 
 
@@ -1,37 +1,31 @@
-import json
+import asyncio
+import functools
 import os
 import pty
+import shlex
+import shutil
 import signal
 import subprocess
 import tempfile
 import time
 from pathlib import Path
+from typing import Any
 
 import click
-import psutil
+import orjson
+import pygit2
 
-from scripts.eval.task_manager import sudo_rm
+from scripts.eval.task_manager import WORK_DIRECTORY, sudo_rm
 
 REPOSITORIES_DIRECTORY = Path("/repositories")
 
+# Project images that were built by `run_tests2`, kept across runs so that the
+# docker build is skipped while the OSS-Fuzz state and the image are unchanged
+IMAGE_CACHE_FILE = (
+    Path(__file__).parent.parent.parent / ".cache" / "oss_fuzz_images.json"
+)
 
-def kill_process_tree(pid: int):
-    try:
-        psutil_process = psutil.Process(pid)
-    except psutil.NoSuchProcess:
-        return
-
-    children = psutil_process.children(recursive=True)
-    for child in children[::-1]:
-        try:
-            child.kill()
-        except psutil.NoSuchProcess:
-            pass
-
-    try:
-        psutil_process.kill()
-    except psutil.NoSuchProcess:
-        pass
+ImageKey = tuple[str, str, str]
 
 
 def run_command(
@@ -41,6 +35,8 @@ def run_command(
     env: dict[str, str] | None = None,
     input: bytes | None = None,
 ) -> tuple[str, str]:
+    # The input is written to a pty since OSS-Fuzz's helper.py only forwards
+    # stdin to the container (`docker run -i`) when stdin is a tty.
     main, sub = pty.openpty()
     process = subprocess.Popen(
         command,
@@ -50,6 +46,8 @@ def run_command(
         stderr=subprocess.PIPE,
         shell=True,
         env=env,
+        # The shell and everything it starts can be killed as a process group
+        start_new_session=True,
     )
     os.close(sub)
 
@@ -67,12 +65,18 @@ def run_command(
                 raise Exception(stdout, stderr)
 
     except subprocess.TimeoutExpired as error:
-        os.kill(process.pid, signal.SIGINT)
-        time.sleep(5)
-        kill_process_tree(process.pid)
+        # The process group may exit at any point, e.g. right at the timeout
+        try:
+            os.killpg(process.pid, signal.SIGINT)
+            time.sleep(5)
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
         stdout, stderr = process.communicate()
 
         raise Exception(stdout, stderr) from error
+    finally:
+        os.close(main)
 
 
 def apply_patch_diff(repo_directory: Path, patch_diff: Path):
@@ -84,47 +88,174 @@ def apply_patch_diff(repo_directory: Path, patch_diff: Path):
 def git_checkout(repository_directory: Path, ref: str | None = None):
     repo = str(repository_directory)
 
+    toplevel, at_ref = _rev_parse_checkout(repo, ref)
+    status = subprocess.check_output(
+        ["git", "-C", repo, "status", "--porcelain", "-z", "--ignored", "--", "."]
+    )
+    if at_ref and status == b"":
+        return
+
     subprocess.run(["git", "-C", repo, "restore", "--source=HEAD", ":/"], check=True)
 
-    subprocess.run(["git", "-C", repo, "clean", "-fdx"], check=True)
+    # Only the untracked and ignored paths that `git status` already found are
+    # removed, instead of walking the whole tree again with `git clean -fdx`.
+    for path in _untracked_paths(status):
+        _remove_path(toplevel / path)
 
     if ref is not None:
         subprocess.run(["git", "-C", repo, "checkout", "-f", ref], check=True)
 
 
+def _rev_parse_checkout(repo: str, ref: str | None) -> tuple[Path, bool]:
+    """Return the top-level directory of the repository and whether HEAD is at
+    `ref` (always true without `ref`), without spawning `git`."""
+    repository = pygit2.Repository(repo)
+    toplevel = Path(repository.workdir)
+    if ref is None:
+        return toplevel, True
+
+    target = repository.revparse_single(ref).peel(pygit2.Commit).id
+    return toplevel, repository.head.target == target
+
+
+def _untracked_paths(status: bytes) -> list[str]:
+    """Parse the untracked (`??`) and ignored (`!!`) paths of
+    `git status --porcelain -z --ignored`, relative to the repository root."""
+    entries = status.decode(errors="surrogateescape").split("\0")
+    paths: list[str] = []
+    index = 0
+    while index < len(entries):
+        entry = entries[index]
+        index += 1
+        if not entry:
+            continue
+        code, path = entry[:2], entry[3:]
+        if code in ("??", "!!"):
+            paths.append(path)
+        elif "R" in code or "C" in code:
+            # Renames and copies are followed by the original path
+            index += 1
+    return paths
+
+
+def _remove_path(path: Path):
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path)
+    else:
+        path.unlink(missing_ok=True)
+
+
+def _image_key(oss_fuzz_directory: Path, project_name: str) -> ImageKey | None:
+    """Identify the project image by the OSS-Fuzz commit it was built from and its
+    current image ID, or return None if the image does not exist."""
+    try:
+        state = str(pygit2.Repository(str(oss_fuzz_directory)).head.target)
+        image_id = subprocess.check_output(
+            [
+                "docker",
+                "image",
+                "inspect",
+                "--format",
+                "{{.Id}}",
+                f"aixcc-afc/{project_name}",
+            ],
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (pygit2.GitError, subprocess.CalledProcessError):
+        return None
+    return project_name, state, image_id
+
+
+@functools.cache
+def _built_images() -> set[ImageKey]:
+    try:
+        entries = orjson.loads(IMAGE_CACHE_FILE.read_bytes())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return set()
+    return {
+        (project_name, state, image_id) for project_name, state, image_id in entries
+    }
+
+
+def _add_built_image(image_key: ImageKey):
+    built_images = _built_images()
+    built_images.add(image_key)
+
+    IMAGE_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+    temporary_file = IMAGE_CACHE_FILE.with_suffix(".tmp")
+    temporary_file.write_bytes(orjson.dumps(sorted(built_images)))
+    os.replace(temporary_file, IMAGE_CACHE_FILE)
+
+
 def run_tests2(
     oss_fuzz_directory: Path,
     project_name: str,
     source_directory: Path,
     test_script: Path,
 ):
-    helper_script = oss_fuzz_directory / "infra" / "helper.py"
-    command = (f"{helper_script} build_image --no-pull --cache {project_name}",)
-    print(command)
-    try:
-        subprocess.check_call(
+    asyncio.run(
+        run_tests2_async(
+            oss_fuzz_directory, project_name, source_directory, test_script
+        )
+    )
+
+
+async def run_tests2_async(
+    oss_fuzz_directory: Path,
+    project_name: str,
+    source_directory: Path,
+    test_script: Path,
+):
+    """Build the project image if needed and run the tests of `source_directory`.
+
+    The commands run as asyncio subprocesses, so that several of these can be
+    awaited together, e.g. building the image of one project while the tests of
+    another are running.
+    """
+    image_key = await asyncio.to_thread(_image_key, oss_fuzz_directory, project_name)
+    if image_key is None or image_key not in _built_images():
+        helper_script = oss_fuzz_directory / "infra" / "helper.py"
+        command = [
+            str(helper_script),
+            "build_image",
+            "--no-pull",
+            "--cache",
+            project_name,
+        ]
+        print(shlex.join(command))
+        await _check_call_async(
             command,
-            shell=True,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
         )
-    except Exception as e:
-        raise e
+
+        image_key = await asyncio.to_thread(
+            _image_key, oss_fuzz_directory, project_name
+        )
+        if image_key is not None:
+            _add_built_image(image_key)
 
     run_tests_script = Path(__file__).parent.parent.parent / Path(
         "third_party/crs-architecture/example-challenge-evaluation/action-run-tests/run_tests.sh"
     )
-    command = (
-        f'{run_tests_script} -p {project_name} -r {source_directory.absolute()} -t "{str(test_script.absolute())}"',
-    )
-    print(command)
-    try:
-        subprocess.check_call(
-            command,
-            shell=True,
-        )
-    except Exception as e:
-        raise e
+    command = [
+        str(run_tests_script),
+        "-p",
+        project_name,
+        "-r",
+        str(source_directory.absolute()),
+        "-t",
+        str(test_script.absolute()),
+    ]
+    print(shlex.join(command))
+    await _check_call_async(command)
+
+
+async def _check_call_async(command: list[str], **kwargs: Any):
+    process = await asyncio.create_subprocess_exec(*command, **kwargs)
+    if (return_code := await process.wait()) != 0:
+        raise subprocess.CalledProcessError(return_code, command)
 
 
 def run_tests(
@@ -164,8 +295,8 @@ def main(patch_diff: Path, detection_name: str, repository_directory: Path):
         click.echo(f"Error: Patch file {patch_diff} does not exist", err=True)
         return
 
-    with open(repository_directory / "detections.json", "r") as f:
-        detections_info = json.load(f)
+    with open(repository_directory / "detections.json", "rb") as f:
+        detections_info = orjson.loads(f.read())
 
     detection_info = detections_info[detection_name]
     cp_name = detection_info["cp_name"]
@@ -174,16 +305,30 @@ def main(patch_diff: Path, detection_name: str, repository_directory: Path):
     oss_fuzz_directory = repository_directory / "oss-fuzz-aixcc"
 
     sudo_rm(oss_fuzz_directory / "build")
-    git_checkout(source_directory, f"challenges/{cp_name}")
     git_checkout(oss_fuzz_directory, f"challenge-state/{cp_name}")
 
-    test_script = source_directory / ".aixcc" / "test.sh"
     # Create temp directory and apply patch
 
-    temporary_directory = Path(tempfile.mkdtemp())
+    if WORK_DIRECTORY is not None:
+        WORK_DIRECTORY.mkdir(parents=True, exist_ok=True)
+    temporary_directory = Path(tempfile.mkdtemp(dir=WORK_DIRECTORY))
     try:
-        # shutil.copytree(source_directory, temporary_directory, dirs_exist_ok=True)
-        os.system(f"cp -rf {source_directory}/* {temporary_directory}/")
+        # A worktree checks out the challenge ref from the objects of the source
+        # repository, so the source directory is neither copied nor checked out.
+        subprocess.check_call(
+            [
+                "git",
+                "-C",
+                str(source_directory),
+                "worktree",
+                "add",
+                "-f",
+                "--detach",
+                str(temporary_directory),
+                f"challenges/{cp_name}",
+            ]
+        )
+        test_script = temporary_directory / ".aixcc" / "test.sh"
         apply_patch_diff(temporary_directory, patch_diff)
 
         # Run tests
@@ -200,7 +345,12 @@ def main(patch_diff: Path, detection_name: str, repository_directory: Path):
         raise click.Abort()
     finally:
         try:
+            # The tests may leave files owned by root, so the worktree is
+            # removed with `sudo_rm` and then pruned from the repository.
             sudo_rm(temporary_directory)
+            subprocess.run(
+                ["git", "-C", str(source_directory), "worktree", "prune"], check=True
+            )
             sudo_rm(oss_fuzz_directory / "build")
         except Exception:
             click.echo("Failed to clean up!", err=True)
@@ -1,15 +1,21 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
 import base64
-import json
+import functools
+import multiprocessing
 import os
+import shlex
 import shutil
 import subprocess
 import sys
 import tarfile
+import threading
 from pathlib import Path
 
+import orjson
+import pygit2
 import toml
 
 sys.path.append(str(Path(__file__).parent))
@@ -24,29 +30,104 @@ from models import (
 )
 
 
+def _work_directory() -> Path | None:
+    """Root for short-lived task working directories, preferably on a tmpfs, e.g.
+    `mount -t tmpfs -o size=16G tmpfs /dev/shm/prism`."""
+    if work_directory := os.environ.get("PRISM_WORK_DIR"):
+        return Path(work_directory)
+    if Path("/dev/shm/prism").is_dir():
+        return Path("/dev/shm/prism")
+    return None
+
+
+WORK_DIRECTORY = _work_directory()
+
+
+class SudoRmDaemon:
+    """A long-lived root container that removes paths on the host.
+
+    The files under the build directories are owned by root, so they are
+    removed from within a container. Starting one container per removal costs
+    a docker spawn each time, so a single `sh` is kept running instead and fed
+    one `rm` per line over its stdin.
+    """
+
+    IMAGE = "ghcr.io/aixcc-finals/base-builder:v1.3.0"
+
+    def __init__(self):
+        self._process: subprocess.Popen[bytes] | None = None
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def remove(self, target: Path):
+        command = f"rm -rf -- {shlex.quote(f'/host{target}')}; echo $?\n"
+        with self._lock:
+            process = self._running_process()
+            assert process.stdin is not None and process.stdout is not None
+            process.stdin.write(command.encode())
+            process.stdin.flush()
+            ack = process.stdout.readline()
+
+        if not ack:
+            raise RuntimeError(f"The sudo rm container exited while removing {target}")
+        if (return_code := int(ack)) != 0:
+            raise subprocess.CalledProcessError(return_code, ["rm", "-rf", str(target)])
+
+    def close(self):
+        with self._lock:
+            if self._process is None:
+                return
+            assert self._process.stdin is not None
+            self._process.stdin.close()
+            self._process.wait()
+            self._process = None
+
+    def _running_process(self) -> subprocess.Popen[bytes]:
+        # A forked child must not share the pipes of its parent's container
+        if self._pid != os.getpid():
+            self._process = None
+            self._pid = os.getpid()
+
+        if self._process is None or self._process.poll() is not None:
+            self._process = subprocess.Popen(
+                [
+                    "docker",
+                    "run",
+                    "--rm",
+                    "-i",
+                    "-v",
+                    "/:/host",
+                    "--workdir",
+                    "/",
+                    self.IMAGE,
+                    "sh",
+                ],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+            )
+        return self._process
+
+
+_sudo_rm_daemon = SudoRmDaemon()
+atexit.register(_sudo_rm_daemon.close)
+
+
 def sudo_rm(target: Path):
     if not target.exists():
         return
 
-    target = target.resolve()
-    cwd = target.parent
-    subprocess.run(
-        [
-            "docker",
-            "run",
-            "--rm",
-            "-i",
-            "-v",
-            f"{cwd}:{cwd}",
-            "--workdir",
-            f"{cwd}",
-            "ghcr.io/aixcc-finals/base-builder:v1.3.0",
-            "rm",
-            "-rf",
-            target,
-        ],
-        check=True,
-    )
+    # Most trees are owned by the current user and are removed in process. The
+    # container is only needed for what root-owned build outputs leave behind.
+    try:
+        if target.is_dir() and not target.is_symlink():
+            shutil.rmtree(target)
+        else:
+            target.unlink()
+        return
+    except PermissionError:
+        pass
+
+    _sudo_rm_daemon.remove(target.resolve())
 
 
 def parse_args():
@@ -56,8 +137,8 @@ def parse_args():
     )
     parser.add_argument(
         "--save-directory",
-        default=".afc/tasks",
-        help="Cache directory for trajectory data (default: .afc/tasks)",
+        default=str(WORK_DIRECTORY / "tasks") if WORK_DIRECTORY else ".afc/tasks",
+        help="Cache directory for trajectory data (default: tasks in $PRISM_WORK_DIR or /dev/shm/prism if available, otherwise .afc/tasks)",
     )
     parser.add_argument(
         "--target",
@@ -73,8 +154,22 @@ def extract_tarball(tarball_path: Path, extract_to: Path):
     """Extract a tarball to the specified directory."""
     if tarball_path.exists():
         print(f"Extracting {tarball_path} to {extract_to}")
-        with tarfile.open(tarball_path, "r:gz") as tar:
-            tar.extractall(path=extract_to)
+        if shutil.which("pigz") is not None:
+            # Decompress with pigz instead of the single-threaded gzip in Python
+            subprocess.run(
+                [
+                    "tar",
+                    "--use-compress-program=pigz",
+                    "-xf",
+                    str(tarball_path),
+                    "-C",
+                    str(extract_to),
+                ],
+                check=True,
+            )
+        else:
+            with tarfile.open(tarball_path, "r:gz") as tar:
+                tar.extractall(path=extract_to)
         return True
     else:
         print(f"Warning: {tarball_path} does not exist")
@@ -84,39 +179,28 @@ def extract_tarball(tarball_path: Path, extract_to: Path):
 def get_head_commit(repo_dir: Path):
     """Get the HEAD commit hash of the git repository in the specified directory."""
     try:
-        result = subprocess.run(
-            ["git", "-C", repo_dir, "rev-parse", "HEAD"],
-            check=True,
-            capture_output=True,
-            text=True,
-        )
-        head_commit = result.stdout.strip()
+        head_commit = str(pygit2.Repository(str(repo_dir)).head.target)
         print(f"HEAD commit in {repo_dir} is {head_commit}")
         return head_commit
-    except subprocess.CalledProcessError as e:
+    except pygit2.GitError as e:
         raise RuntimeError(f"Error getting HEAD commit: {e}")
 
 
 def setup_git_repo(repo_dir: Path) -> CommitHexString:
     """Initialize git repository in the specified directory. Then, return the initial commit hash."""
     try:
-        subprocess.run(["git", "-C", repo_dir, "init"], check=True)
-        subprocess.run(
-            ["git", "-C", repo_dir, "config", "user.name", "Your Name"], check=True
-        )
-        subprocess.run(
-            ["git", "-C", repo_dir, "config", "user.email", "you@example.com"],
-            check=True,
-        )
+        repository = pygit2.init_repository(str(repo_dir))
+        repository.config["user.name"] = "Your Name"
+        repository.config["user.email"] = "you@example.com"
         # initial commit
+        # `git add .` is kept as a command since it records embedded git
+        # repositories as gitlinks, which `index.add_all` fails on.
         subprocess.run(["git", "-C", repo_dir, "add", "."], check=True)
-        subprocess.run(
-            ["git", "-C", repo_dir, "commit", "-m", "Initial commit"], check=True
-        )
+        repository.index.read()
+        commit = _commit_index(repository, "Initial commit")
         print(f"Initialized git repository in {repo_dir}")
-        # Get the initial commit hash
-        return get_head_commit(repo_dir)
-    except subprocess.CalledProcessError as e:
+        return commit
+    except (subprocess.CalledProcessError, pygit2.GitError) as e:
         print(f"Error initializing git repository: {e}")
         raise
 
@@ -124,28 +208,44 @@ def setup_git_repo(repo_dir: Path) -> CommitHexString:
 def apply_diff_and_commit(repo_dir: Path, diff_path: Path) -> CommitHexString:
     """Apply a diff file to the repository and commit changes."""
     try:
+        # `git apply --reject` and `git add --all -f` are kept as commands since
+        # partially applied diffs, deletions and ignored files must be committed.
         subprocess.run(
             ["git", "-C", repo_dir, "apply", "--reject", diff_path.absolute()],
         )
         subprocess.run(["git", "-C", repo_dir, "add", "--all", "-f"], check=True)
-        subprocess.run(
-            ["git", "-C", repo_dir, "commit", "-m", "Applied diff patch"], check=True
-        )
+        repository = pygit2.Repository(str(repo_dir))
+        commit = _commit_index(repository, "Applied diff patch")
         print(f"Applied and committed diff from {diff_path}")
-        # Get the new commit hash
-        return get_head_commit(repo_dir)
-    except subprocess.CalledProcessError as e:
+        return commit
+    except (subprocess.CalledProcessError, pygit2.GitError) as e:
         print(f"Error applying diff or committing: {e}")
         raise
 
 
+def _commit_index(repository: pygit2.Repository, message: str) -> CommitHexString:
+    """Commit the index of the repository on top of HEAD and return the commit hash."""
+    parents = [] if repository.head_is_unborn else [repository.head.target]
+    signature = repository.default_signature
+    commit = repository.create_commit(
+        "HEAD",
+        signature,
+        signature,
+        message,
+        repository.index.write_tree(),
+        parents,
+    )
+    print(f"HEAD commit in {repository.workdir} is {commit}")
+    return str(commit)
+
+
 def get_tarball_metadata(target_directory: Path) -> TarballMetadata:
     metadata_path = target_directory / "metadata.json"
     if not metadata_path.exists():
         raise ValueError(f"Error: metadata.json not found in {target_directory}")
 
-    with open(metadata_path, "r") as f:
-        metadata = json.load(f)
+    with open(metadata_path, "rb") as f:
+        metadata = orjson.loads(f.read())
         try:
             return TarballMetadata.model_validate(metadata)
         except Exception as e:
@@ -240,7 +340,7 @@ def prepare_task(target_directory: Path, save_directory: Path) -> Path:
         blob_info = AIxCCChallengeBlobInfo(
             harness_name=harness_name,
             sanitizer_name=sanitizer,
-            blob=base64.b64encode(blob).decode(errors="replace"),
+            blob=base64.b64encode(blob).decode("ascii"),
         )
 
         detections.append(
@@ -273,10 +373,7 @@ def prepare_task(target_directory: Path, save_directory: Path) -> Path:
         oss_fuzz_directory=str(oss_fuzz_directory.relative_to(task_directory)),
     )
     (task_directory / "metadata.json").write_text(task_metadata.model_dump_json())
-    zzz = TaskMetadata.model_validate_json(
-        (task_directory / "metadata.json").read_text()
-    )
-    print(f"Task directory: {zzz.project_name}")
+    print(f"Task directory: {task_metadata.project_name}")
     return task_directory
 
 
@@ -292,8 +389,8 @@ def save_detection(detection_path: Path, detection: AIxCCChallengeProjectDetecti
 
 
 def clean_task_directory(task_directory: Path):
-    with open(task_directory / "metadata.json", "r") as f:
-        metadata = json.load(f)
+    with open(task_directory / "metadata.json", "rb") as f:
+        metadata = orjson.loads(f.read())
 
     subprocess.run(
         [
@@ -314,6 +411,20 @@ def clean_task_directory(task_directory: Path):
         sudo_rm(build_directory)
 
 
+def _safe_prepare(
+    target_directory: Path, save_directory: Path
+) -> tuple[Path, Path | None, Exception | None]:
+    """Run `prepare_task` and return the error instead of raising it, so that one
+    failing task does not stop the others in the pool."""
+    print(f"Processing {target_directory}")
+    try:
+        if not (target_directory / "metadata.json").exists():
+            return target_directory, None, None
+        return target_directory, prepare_task(target_directory, save_directory), None
+    except Exception as e:
+        return target_directory, None, e
+
+
 if __name__ == "__main__":
     args = parse_args()
     save_directory = Path(args.save_directory)
@@ -321,17 +432,34 @@ if __name__ == "__main__":
     if args.target:
         tarball_directories = [Path(args.afc_tarballs_directory) / args.target]
     else:
-        tarball_directories = Path(args.afc_tarballs_directory).glob("*/")
+        tarball_directories = list(Path(args.afc_tarballs_directory).glob("*/"))
+
+    pool = None
+    if len(tarball_directories) <= 1:
+        # Starting workers for a single task only adds to its run time
+        results = [
+            _safe_prepare(target_directory, save_directory)
+            for target_directory in tarball_directories
+        ]
+    else:
+        # The pool is kept for the whole run instead of being created per task
+        pool = multiprocessing.Pool(
+            processes=max(1, min(os.cpu_count() or 1, len(tarball_directories)))
+        )
+        results = pool.imap_unordered(
+            functools.partial(_safe_prepare, save_directory=save_directory),
+            tarball_directories,
+        )
 
-    for target_directory in tarball_directories:
-        print(f"Processing {target_directory}")
-        try:
-            if not (target_directory / "metadata.json").exists():
-                continue
-            task_directory = prepare_task(target_directory, save_directory)
-            print(f"OSS-Fuzz project directory: {task_directory}")
-        except Exception as e:
-            print(f"Error processing {target_directory}: {e}")
+    for target_directory, task_directory, error in results:
+        if error is not None:
+            print(f"Error processing {target_directory}: {error}")
             # log to file
             with open(f"logs/{target_directory.name}.log", "a") as f:
-                f.write(f"{e}\n")
+                f.write(f"{error}\n")
+        elif task_directory is not None:
+            print(f"OSS-Fuzz project directory: {task_directory}")
+
+    if pool is not None:
+        pool.close()
+        pool.join()